@@ -0,0 +1,18 @@
+from collections import Counter
+
+from constants import CANDIDATE_NAMES
+
+def aggregate_votes(parsed_votes):
+    """
+    Sum the votes of every candidate across many PDFs.
+    A candidate listed more than once in a PDF has all of its rows counted.
+    Returns a list of {"name", "votes"} dicts in CANDIDATE_NAMES order.
+    """
+    totals = Counter()
+    for votes in parsed_votes:
+        for vote in votes:
+            totals[vote["name"]] += vote["votes"]
+    return [
+        {"name": name, "votes": totals[name]}
+        for name in CANDIDATE_NAMES
+    ]
@@ -1,26 +1,129 @@
-import json
+import asyncio
+import functools
+import mmap
+import multiprocessing
 import os
+import orjson
 import pdfplumber
-import requests
+import aiofiles
+import aiohttp
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
+from aggregate import aggregate_votes
 from vote_parser import parse_candidate_votes, format_results, compare_vote_results
 from table_parser import parse_table_votes, format_table_results
 import pdf2image
+import cv2
+import numpy as np
 from PIL import Image
 import io
-import base64
 import sys
 import subprocess
-import pytesseract
+import tempfile
+from tesserocr import PSM, PyTessBaseAPI
 from google.cloud import vision
 from datetime import datetime
 
 timestamp = int(datetime.now().timestamp())
 
+DOWNLOAD_CONCURRENCY = 32
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Chunks are written in batches of up to this many bytes so most PDFs
+# reach the disk in a single hop to the file I/O thread
+DOWNLOAD_WRITE_BATCH_SIZE = 1024 * 1024
+
+# Pages are rendered for OCR at their native scan resolution, kept in this range
+MIN_OCR_DPI = 200
+MAX_OCR_DPI = 300
+
+
+def create_session(headers):
+    """Create an HTTP session whose connection pool is shared by all download workers"""
+    connector = aiohttp.TCPConnector(limit=DOWNLOAD_CONCURRENCY)
+    return aiohttp.ClientSession(headers=headers, connector=connector, raise_for_status=True)
+
+
+async def fetch_json(session, url):
+    """Download and decode a JSON document"""
+    async with session.get(url) as response:
+        # Decode the raw body so the server's content type label doesn't matter
+        return orjson.loads(await response.read())
+
+
+async def fetch(session, url, dest):
+    """
+    Stream a file to disk without buffering it in memory.
+    The download goes to a .part file that is renamed once complete.
+    Returns the BLAKE2b hex digest of the downloaded content.
+    """
+    partial_dest = f"{dest}.part"
+    digest = hashlib.blake2b()
+    async with session.get(url) as response:
+        async with aiofiles.open(partial_dest, 'wb') as f:
+            batch = []
+            batch_size = 0
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                batch.append(chunk)
+                batch_size += len(chunk)
+                if batch_size >= DOWNLOAD_WRITE_BATCH_SIZE:
+                    await f.writelines(batch)
+                    batch = []
+                    batch_size = 0
+            if batch:
+                await f.writelines(batch)
+    os.replace(partial_dest, dest)
+    return digest.hexdigest()
+
+
+def get_file_digest(path):
+    """Return the BLAKE2b hex digest of a file's content"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'blake2b').hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def get_tesseract_api():
+    """
+    Return the Tesseract engine for this process.
+    It is created once so the OCR model is not reloaded for every PDF.
+    """
+    return PyTessBaseAPI(psm=PSM.SPARSE_TEXT)
+
+
+def get_ocr_dpi(page):
+    """
+    Pick the resolution to render a page at for OCR.
+    Rendering a scan above the resolution it was scanned at only upsamples it,
+    so the render DPI follows the embedded scan, within MIN_OCR_DPI..MAX_OCR_DPI.
+    Pages without an embedded scan keep the previous 200 DPI default.
+    """
+    scan_dpis = [
+        image["srcsize"][0] / (image["width"] / 72)
+        for image in page.images if image["width"]
+    ]
+    if not scan_dpis:
+        return MIN_OCR_DPI
+    return max(MIN_OCR_DPI, min(MAX_OCR_DPI, round(max(scan_dpis))))
+
+
+def preprocess_for_ocr(image):
+    """Denoise and binarize a grayscale page image so Tesseract sees clean text"""
+    pixels = cv2.bilateralFilter(np.array(image), d=5, sigmaColor=2, sigmaSpace=2)
+    pixels = cv2.adaptiveThreshold(
+        pixels, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2
+    )
+    return Image.fromarray(pixels)
+
+
+@functools.lru_cache(maxsize=1)
 def check_poppler_installation():
-    """Check if poppler is installed and accessible"""
+    """
+    Check if poppler is installed and accessible.
+    The result is cached so the check runs once per process, not once per PDF.
+    """
     try:
         # Try to run pdftoppm (part of poppler) with version flag
         subprocess.run(['pdftoppm', '-v'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -34,6 +137,37 @@ def check_poppler_installation():
         return False
 
 
+# Page fields derived from the extracted text and tables. They are not cached,
+# so cached pages always go through the current parsers.
+PARSED_PAGE_FIELDS = (
+    "text_parsed_votes",
+    "text_formatted_results",
+    "ocr_parsed_votes",
+    "ocr_formatted_results",
+    "ocr_total_votes",
+    "vote_comparison",
+)
+
+
+def parse_page_votes(page_content):
+    """Parse the votes from a page's extracted text and tables into its content"""
+    text_tables = page_content["text_tables"]
+    ocr_parsed_votes = parse_candidate_votes(page_content["text"])
+    text_parsed_votes = parse_table_votes(text_tables[0] if text_tables else [])
+    page_content.update({
+        "text_parsed_votes": text_parsed_votes,
+        "text_formatted_results": format_table_results(text_parsed_votes),
+        "ocr_parsed_votes": ocr_parsed_votes,
+        "ocr_formatted_results": format_results(ocr_parsed_votes),
+        "ocr_total_votes": sum(vote["votes"] for vote in ocr_parsed_votes),
+        "vote_comparison": compare_vote_results(
+            text_parsed_votes,
+            ocr_parsed_votes
+        )
+    })
+    return page_content
+
+
 def extract_pdf_content(pdf_path, use_google_vision=False, page_number=2):
     """
     Extract all content from a PDF file including text, tables, and images.
@@ -52,45 +186,43 @@ def extract_pdf_content(pdf_path, use_google_vision=False, page_number=2):
         "pages": []
     }
 
-    # Extract text and tables using pdfplumber
-    with pdfplumber.open(pdf_path) as pdf:
+    # Extract text and tables using pdfplumber, reading the PDF through a
+    # memory map so pdfminer's seeks and reads hit the page cache directly
+    with open(pdf_path, 'rb') as pdf_fp, \
+            mmap.mmap(pdf_fp.fileno(), 0, access=mmap.ACCESS_READ) as pdf_map, \
+            pdfplumber.open(pdf_map) as pdf:
         if page_number > len(pdf.pages):
             raise ValueError(f"PDF only has {len(pdf.pages)} pages, requested page {page_number}")
 
         page = pdf.pages[page_number - 1]
+        ocr_dpi = get_ocr_dpi(page)
+        # Each of these re-runs pdfplumber's layout analysis, so do them once
+        text = page.extract_text() or ""
         text_tables = [table.extract() for table in page.find_tables()]
-        ocr_parsed_votes = parse_candidate_votes(page.extract_text() or "")
-        text_parsed_votes = parse_table_votes(text_tables[0] if text_tables else [])
         page_content = {
             "page_number": page_number,
-            "text": page.extract_text() or "",
+            "text": text,
             "text_tables": text_tables,
-            "text_parsed_votes": text_parsed_votes,
-            "text_formatted_results": format_table_results(text_parsed_votes),
-            "ocr_parsed_votes": ocr_parsed_votes,
-            "ocr_formatted_results": format_results(ocr_parsed_votes),
-            "ocr_total_votes": sum(vote["votes"] for vote in ocr_parsed_votes),
-            "vote_comparison": compare_vote_results(
-                text_parsed_votes,
-                ocr_parsed_votes
-            )
         }
-        result["pages"].append(page_content)
+        result["pages"].append(parse_page_votes(page_content))
 
     # Extract images using pdf2image
-    images = pdf2image.convert_from_path(pdf_path, first_page=page_number, last_page=page_number)
+    images = pdf2image.convert_from_path(
+        pdf_path,
+        dpi=ocr_dpi,
+        first_page=page_number,
+        last_page=page_number,
+        grayscale=True
+    )
     for image in images:
-        # Convert PIL Image to base64 and bytes
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr_val = img_byte_arr.getvalue()
-        img_base64 = base64.b64encode(img_byte_arr_val).decode('utf-8')
-
-        # Add image to the corresponding page
-        result["pages"][0]["image"] = "img_base64"
-
         # Perform OCR
         if use_google_vision:
+            # Google Vision needs encoded image bytes; JPEG is much smaller
+            # than PNG for scanned pages and is accepted by the API
+            img_byte_arr = io.BytesIO()
+            image.save(img_byte_arr, format='JPEG', quality=85)
+            img_byte_arr_val = img_byte_arr.getvalue()
+
             # Use Google Vision API
             vision_client = vision.ImageAnnotatorClient()
             vision_image = vision.Image(content=img_byte_arr_val)
@@ -106,9 +238,11 @@ def extract_pdf_content(pdf_path, use_google_vision=False, page_number=2):
                     0].confidence if document_response.full_text_annotation.pages else 0
             }
         else:
-            # Use Tesseract OCR
+            # Use Tesseract OCR, which takes the PIL image directly
             try:
-                ocr_text = pytesseract.image_to_string(image)
+                tesseract_api = get_tesseract_api()
+                tesseract_api.SetImage(preprocess_for_ocr(image))
+                ocr_text = tesseract_api.GetUTF8Text()
                 result["pages"][0]["ocr"] = {
                     "provider": "tesseract",
                     "text": ocr_text,
@@ -130,8 +264,8 @@ def save_to_json(pdf_path, output_path=None, use_google_vision=False, page_numbe
     content = extract_pdf_content(pdf_path, use_google_vision=use_google_vision, page_number=page_number)
 
     if output_path:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(content, f, indent=2, ensure_ascii=False)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(content, option=orjson.OPT_INDENT_2))
 
     return content
 
@@ -159,8 +293,74 @@ def cli():
     print(f"PDF content extracted to: {output_file}")
 
 
-def process_file(file_data, headers, processed_files):
-    """Worker function to process a single file"""
+def is_done(pdf_file):
+    """Check whether a file was fully processed, in this run or an earlier one"""
+    return os.path.exists(f"data/done/{pdf_file}")
+
+
+def mark_done(pdf_file, pdf_hash):
+    """Record that a file was fully processed with a marker holding its content hash"""
+    with open(f"data/done/{pdf_file}", 'w') as f:
+        f.write(pdf_hash)
+
+
+def load_done_content(pdf_file):
+    """Return the cached content of a file marked as processed, if it is still cached"""
+    with open(f"data/done/{pdf_file}") as f:
+        pdf_hash = f.read().strip()
+    return load_cached_content(pdf_hash) if pdf_hash else None
+
+
+def load_cached_content(pdf_hash):
+    """
+    Return the content previously extracted from a PDF with this hash, if any.
+    The votes are parsed again, so parser changes apply to cached PDFs too.
+    """
+    cache_filename = f"data/cache/{pdf_hash}.json"
+    if not os.path.exists(cache_filename):
+        return None
+    with open(cache_filename, 'rb') as f:
+        content = orjson.loads(f.read())
+    for page_content in content["pages"]:
+        parse_page_votes(page_content)
+    return content
+
+
+def save_cached_content(pdf_hash, content):
+    """Cache the raw content extracted from a PDF (text, tables, OCR) under its hash"""
+    cache_filename = f"data/cache/{pdf_hash}.json"
+    raw_content = {
+        "pages": [
+            {key: value for key, value in page_content.items() if key not in PARSED_PAGE_FIELDS}
+            for page_content in content["pages"]
+        ]
+    }
+    # Identical PDFs from different precincts may be saved concurrently from
+    # executor threads, so each write goes to its own temporary file
+    fd, partial_filename = tempfile.mkstemp(dir="data/cache", suffix=".part")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(orjson.dumps(raw_content))
+    os.replace(partial_filename, cache_filename)
+
+
+def save_problem_report(id, content):
+    """Save the full content of a PDF whose text and OCR votes don't match"""
+    os.makedirs("data/problems", exist_ok=True)
+    with open(f"data/problems/{id}.json", 'wb') as f:
+        f.write(orjson.dumps(content, option=orjson.OPT_INDENT_2))
+
+
+def has_ocr_error(content):
+    """Check whether OCR failed on any page, e.g. because tessdata is missing"""
+    return any("error" in page_content.get("ocr", {}) for page_content in content["pages"])
+
+
+async def process_file(file_data, session, pool):
+    """
+    Download a single file and extract its content in the process pool.
+    Returns the votes parsed from the results table, or None if the precinct
+    has no PV file. Download and extraction errors are raised.
+    """
     id, f = file_data
     if not f:
         print(f"File not found for {id}")
@@ -171,49 +371,68 @@ def process_file(file_data, headers, processed_files):
     
     pdf_url = f"https://prezenta.roaep.ro/prezidentiale24112024/{f[0].get('url')}"
     
-    # Generate a unique filename based on the URL
-    pdf_file = pdf_url.split("/")[-1]
+    # Generate a unique filename based on a hash of the URL, since upstream
+    # file names are reused across counties
+    pdf_file = hashlib.blake2b(pdf_url.encode(), digest_size=16).hexdigest()
     os.makedirs("data/pdfs", exist_ok=True)
-    saved_filename = f"data/pdfs/{pdf_file}"
+    saved_filename = f"data/pdfs/{pdf_file}.pdf"
+    os.makedirs("data/done", exist_ok=True)
+    os.makedirs("data/cache", exist_ok=True)
     
-    # Check if file was already processed
-    if pdf_file in processed_files:
-        print(f"Skipping already processed file: {id}")
-        return
+    loop = asyncio.get_running_loop()
+
+    # Check if file was already processed. If its cached content is gone,
+    # process it again so it still counts towards the totals. Cache reads,
+    # writes and re-parsing run on the default executor so the event loop
+    # keeps serving downloads.
+    if is_done(pdf_file):
+        content = await loop.run_in_executor(None, load_done_content, pdf_file)
+        if content is not None:
+            print(f"Skipping already processed file: {id}")
+            return content.get('pages')[0].get('text_parsed_votes')
+        print(f"Cached content missing for processed file, reprocessing: {id}")
     
     print(f"Downloading {pdf_url}")
     
     # Download pdf file if it doesn't exist
-    if not os.path.exists(saved_filename):
-        pdf_file = requests.request("GET", pdf_url, headers=headers)
-        with open(saved_filename, "wb") as f:
-            f.write(pdf_file.content)
+    if os.path.exists(saved_filename):
+        pdf_hash = await loop.run_in_executor(None, get_file_digest, saved_filename)
+    else:
+        pdf_hash = await fetch(session, pdf_url, saved_filename)
     
     print(f"Processing {saved_filename}")
-    try:
-        content = extract_pdf_content(saved_filename, use_google_vision=False, page_number=2)
-        is_matching = content.get('pages')[0].get('vote_comparison').get('all_match')
-        
-        if not is_matching:
-            print(f"The votes don't match for {id}")
-            os.makedirs("data/problems", exist_ok=True)
-            with open(f"data/problems/{id}.json", 'w', encoding='utf-8') as f:
-                json.dump(content, f, indent=2, ensure_ascii=False)
-        
-        # Mark file as processed
-        processed_files.add(pdf_file)
-    except Exception as e:
-        print(f"Error processing {id}: {str(e)}")
-
-def parse_county(url, headers={}):
-    # Load previously processed files if tracking file exists
-    processed_files = set()
-    for file in os.listdir("data/pdfs"):
-        processed_files.add(file)
-
+    # Identical PDFs are only extracted once, even across runs
+    content = await loop.run_in_executor(None, load_cached_content, pdf_hash)
+    if content is None:
+        # PDF parsing and OCR are CPU bound, so they run outside the event loop
+        content = await loop.run_in_executor(
+            pool,
+            functools.partial(extract_pdf_content, saved_filename, use_google_vision=False, page_number=2)
+        )
+        # Don't persist an OCR failure: the PDF would never be OCRed again
+        if not has_ocr_error(content):
+            await loop.run_in_executor(None, save_cached_content, pdf_hash, content)
+    is_matching = content.get('pages')[0].get('vote_comparison').get('all_match')
+    
+    if not is_matching:
+        print(f"The votes don't match for {id}")
+        await loop.run_in_executor(None, save_problem_report, id, content)
+    
+    # Mark file as processed, unless OCR failed so it is retried next run
+    if has_ocr_error(content):
+        print(f"OCR failed for {id}, it will be processed again on the next run")
+    else:
+        await loop.run_in_executor(None, mark_done, pdf_file, pdf_hash)
+    return content.get('pages')[0].get('text_parsed_votes')
+
+async def parse_county(url, session, pool):
+    """
+    Process every PDF of a county.
+    Returns the non-empty votes parsed from each PDF, and a Counter of how many
+    precincts were processed, failed, had no PV file or had no votes parsed.
+    """
     print(f"Processing {url}")
-    response = requests.request("GET", url, headers=headers)
-    data = response.json()
+    data = await fetch_json(session, url)
     
     # Prepare the list of files to process
     files_to_process = []
@@ -223,19 +442,37 @@ def parse_county(url, headers={}):
              file.get('report_stage_code') == 'FINAL']
         files_to_process.append((id, f))
     
-    # Process files using thread pool
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = [executor.submit(process_file, file_data, headers, processed_files)
-                  for file_data in files_to_process]
-        
-        # Wait for all tasks to complete
-        for future in as_completed(futures):
+    queue = asyncio.Queue()
+    for file_data in files_to_process:
+        queue.put_nowait(file_data)
+    county_votes = []
+    county_stats = Counter()
+
+    async def worker():
+        while True:
             try:
-                future.result()
+                file_data = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                votes = await process_file(file_data, session, pool)
             except Exception as e:
-                print(f"An error occurred: {str(e)}")
-
-def process_entire_country():
+                print(f"Error processing {file_data[0]}: {str(e)}")
+                county_stats["failed"] += 1
+                continue
+            if votes is None:
+                county_stats["missing"] += 1
+            elif not votes:
+                county_stats["empty"] += 1
+            else:
+                county_stats["processed"] += 1
+                county_votes.append(votes)
+
+    # Download files concurrently, bounded by the number of worker coroutines
+    await asyncio.gather(*(worker() for _ in range(DOWNLOAD_CONCURRENCY)))
+    return county_votes, county_stats
+
+async def process_entire_country():
     headers = {
         'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
         'accept-language': 'en-GB,en-US;q=0.9,en;q=0.8,ro;q=0.7',
@@ -256,13 +493,33 @@ def process_entire_country():
         'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
     }
 
-    url = f"https://prezenta.roaep.ro/prezidentiale24112024/data/json/sicpv/lists/counties.json?_={timestamp}"
-    response = requests.request("GET", url, headers=headers)
-    data = response.json()
-    for county in data:
-        county_url = f"https://prezenta.roaep.ro/prezidentiale24112024/data/json/sicpv/pv/pv_{county.get('code').lower()}.json?_={timestamp}"
-        parse_county(county_url, headers)
+    # One worker process per core, shared by all counties so the workers
+    # are started only once per run. Workers start lazily, after the event
+    # loop already runs executor threads, so they must not be forked from it.
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("forkserver")
+    ) as pool:
+        async with create_session(headers) as session:
+            url = f"https://prezenta.roaep.ro/prezidentiale24112024/data/json/sicpv/lists/counties.json?_={timestamp}"
+            data = await fetch_json(session, url)
+            country_votes = []
+            country_stats = Counter()
+            for county in data:
+                county_url = f"https://prezenta.roaep.ro/prezidentiale24112024/data/json/sicpv/pv/pv_{county.get('code').lower()}.json?_={timestamp}"
+                county_votes, county_stats = await parse_county(county_url, session, pool)
+                country_votes += county_votes
+                country_stats += county_stats
+
+    country_results = format_table_results(aggregate_votes(country_votes))
+    print(f"Country totals from {country_stats['processed']} precincts ({country_results['total_votes']} votes):")
+    print(format_results(country_results["candidates"]))
+    print(
+        f"Not included: {country_stats['failed']} failed to download or extract, "
+        f"{country_stats['missing']} had no PV file, "
+        f"{country_stats['empty']} had no votes parsed from the results table"
+    )
 
 
 if __name__ == '__main__':
-    process_entire_country()
+    asyncio.run(process_entire_country())
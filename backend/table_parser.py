@@ -1,3 +1,9 @@
+from operator import itemgetter
+
+from constants import CANDIDATE_NAMES
+
+_CANDIDATE_SET = frozenset(CANDIDATE_NAMES)
+
 def parse_table_votes(table_data):
     """Parse candidate votes from table format"""
     # Skip header row and empty rows
@@ -7,17 +13,14 @@ def parse_table_votes(table_data):
         
     for row in table_data[1:]:  # Skip header row
         if len(row) >= 3 and row[1] and row[2]:  # Ensure row has name and votes
-            try:
-                votes = int(row[2])
-                name = row[1].strip()
-                # Only add if name is in CANDIDATE_NAMES
-                if name in CANDIDATE_NAMES:
-                    candidates.append({
-                        "name": name,
-                        "votes": votes
-                    })
-            except ValueError:
-                continue
+            name = row[1].strip()
+            votes = row[2].strip()
+            # Only add if name is in CANDIDATE_NAMES and votes is a plain number
+            if name in _CANDIDATE_SET and votes.isdecimal():
+                candidates.append({
+                    "name": name,
+                    "votes": int(votes)
+                })
     
     return candidates
 
@@ -31,20 +34,19 @@ def format_table_results(candidates):
     
     total_votes = sum(c["votes"] for c in candidates)
     
-    formatted_candidates = []
-    for candidate in candidates:
-        percentage = (candidate["votes"] / total_votes * 100) if total_votes > 0 else 0
-        formatted_candidates.append({
+    # Sort by votes in descending order
+    ranked_candidates = sorted(candidates, key=itemgetter("votes"), reverse=True)
+    
+    formatted_candidates = [
+        {
             "name": candidate["name"],
             "votes": candidate["votes"],
-            "percentage": round(percentage, 2)
-        })
-    
-    # Sort by votes in descending order
-    formatted_candidates.sort(key=lambda x: x["votes"], reverse=True)
+            "percentage": round(candidate["votes"] / total_votes * 100, 2) if total_votes > 0 else 0
+        }
+        for candidate in ranked_candidates
+    ]
     
     return {
         "total_votes": total_votes,
         "candidates": formatted_candidates
     }
-from constants import CANDIDATE_NAMES
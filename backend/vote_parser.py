@@ -1,28 +1,33 @@
 import re
+import ahocorasick
 from constants import CANDIDATE_NAMES
 
+# Automaton matching every candidate name in a single pass over the text
+_CANDIDATE_AUTOMATON = ahocorasick.Automaton()
+for _name in CANDIDATE_NAMES:
+    _CANDIDATE_AUTOMATON.add_word(_name, _name)
+_CANDIDATE_AUTOMATON.make_automaton()
+
+# Pattern to match the vote count that follows a candidate name
+_VOTES_RE = re.compile(r'\s+(\d+)')
+
 def parse_candidate_votes(text):
     """
     Parse votes for each candidate from the text.
     Returns a list of tuples (name, votes)
     """
-    # Pattern to match fully uppercase candidate name followed by number
-    pattern = r'([A-ZĂÎÂȘȚ][A-ZĂÎÂȘȚ\s\-\.]+)\s+(\d+)'
-    
-    # Find all matches in text
-    matches = re.findall(pattern, text)
-    
-    # Process matches into dictionary format
     results = []
-    for name, votes in matches:
-        # Clean up name and convert votes to int
-        name = name.strip()
-        votes = int(votes)
-        # Validate against CANDIDATE_NAMES
-        if name in CANDIDATE_NAMES and votes >= 0:
+    for end_index, name in _CANDIDATE_AUTOMATON.iter(text):
+        start_index = end_index - len(name) + 1
+        # Skip names that are only the tail of a longer word
+        if start_index > 0 and text[start_index - 1].isalpha():
+            continue
+        # The name must be followed by whitespace and its vote count
+        votes_match = _VOTES_RE.match(text, end_index + 1)
+        if votes_match:
             results.append({
                 "name": name,
-                "votes": votes
+                "votes": int(votes_match.group(1))
             })
             
     return results
@@ -36,44 +41,19 @@ def format_results(results):
 
 def compare_vote_results(text_votes, ocr_votes):
     """Compare two sets of voting results and return differences"""
-    differences = []
-    all_match = True
-    
     # Create dictionaries for easier comparison
     text_dict = {v["name"]: v["votes"] for v in text_votes}
     ocr_dict = {v["name"]: v["votes"] for v in ocr_votes}
     
-    # Check all expected candidate names
-    for name in CANDIDATE_NAMES:
-        text_votes = text_dict.get(name)
-        ocr_votes = ocr_dict.get(name)
-        
-        if text_votes is None or ocr_votes is None:
-            all_match = False
-            differences.append({
-                "name": name,
-                "text_votes": text_votes,
-                "ocr_votes": ocr_votes
-            })
-        elif text_votes != ocr_votes:
-            all_match = False
-            differences.append({
-                "name": name,
-                "text_votes": text_votes,
-                "ocr_votes": ocr_votes
-            })
-    
-    # Check for names in OCR that weren't in text
-    for name, votes in ocr_dict.items():
-        if name not in text_dict:
-            all_match = False
-            differences.append({
-                "name": name,
-                "text_votes": None,
-                "ocr_votes": votes
-            })
+    # Every expected candidate must be present in the text results and match OCR
+    votes_by_name = ((name, text_dict.get(name), ocr_dict.get(name)) for name in CANDIDATE_NAMES)
+    differences = [
+        {"name": name, "text_votes": text_count, "ocr_votes": ocr_count}
+        for name, text_count, ocr_count in votes_by_name
+        if text_count is None or text_count != ocr_count
+    ]
     
     return {
-        "all_match": all_match,
+        "all_match": not differences,
         "differences": differences
     }